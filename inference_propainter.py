@@ -99,9 +99,16 @@ def render_mask_from_regions(width, height, regions, origin):
 
 
 def maybe_generate_mask_from_regions(args, video_name, width, height):
+    """Render the region mask in memory.
+
+    Returns (temp_dir, mask_path, mask). The mask is only written to disk when
+    it should outlive the run (--mask_output or --keep_auto_mask); otherwise
+    temp_dir and mask_path are None and the array is passed straight to
+    read_mask.
+    """
     has_regions = bool(args.regions or args.region_json)
     if not has_regions:
-        return None, None
+        return None, None, None
     if args.mode != 'video_inpainting':
         raise ValueError("Region-based mask generation is only supported in video_inpainting mode.")
 
@@ -120,14 +127,16 @@ def maybe_generate_mask_from_regions(args, video_name, width, height):
         mask_path = Path(args.mask_output).expanduser().resolve()
         mask_path.parent.mkdir(parents=True, exist_ok=True)
         temp_dir = None
-    else:
+    elif args.keep_auto_mask:
         temp_dir = Path(tempfile.mkdtemp(prefix="propainter_auto_mask_"))
         mask_path = temp_dir / f"{video_name}_mask.png"
+    else:
+        return None, None, mask
 
     if not cv2.imwrite(str(mask_path), mask):
         raise IOError(f"Failed to write auto-generated mask to {mask_path}")
 
-    return temp_dir, str(mask_path)
+    return temp_dir, str(mask_path), mask
 
 def imwrite(img, file_path, params=None, auto_mkdir=True):
     if auto_mkdir:
@@ -179,13 +188,15 @@ def binary_mask(mask, th=0.1):
     return mask
 
 
-# read frame-wise masks
+# read frame-wise masks (mpath may also be an in-memory HxW uint8 mask)
 def read_mask(mpath, length, size, flow_mask_dilates=8, mask_dilates=5):
     masks_img = []
     masks_dilated = []
     flow_masks = []
 
-    if mpath.endswith(('jpg', 'jpeg', 'png', 'JPG', 'JPEG', 'PNG')): # input single img path
+    if isinstance(mpath, np.ndarray):
+        masks_img = [Image.fromarray(mpath)]
+    elif mpath.endswith(('jpg', 'jpeg', 'png', 'JPG', 'JPEG', 'PNG')): # input single img path
        masks_img = [Image.open(mpath)]
     else:
         mnames = sorted(os.listdir(mpath))
@@ -296,7 +307,7 @@ def split_video_by_duration(video_path, segment_duration, output_dir):
     output_pattern = str(output_dir / "segment_%03d.mp4")
 
     cmd = [
-        'ffmpeg', '-i', video_path,
+        'ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error', '-i', video_path,
         '-c', 'copy',
         '-map', '0',
         '-segment_time', str(segment_duration),
@@ -307,34 +318,45 @@ def split_video_by_duration(video_path, segment_duration, output_dir):
     ]
 
     print(f"Splitting video into {segment_duration}s segments...")
-    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    subprocess.run(cmd, check=True, stdin=subprocess.DEVNULL,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
     segments = sorted(output_dir.glob("segment_*.mp4"))
     print(f"Created {len(segments)} segments")
     return segments
 
 
-def merge_videos_ffmpeg(video_list, output_path):
-    """Merge video segments using ffmpeg"""
-    list_file = Path(tempfile.gettempdir()) / f"video_list_{os.getpid()}.txt"
-
-    with open(list_file, 'w') as f:
-        for video in video_list:
-            f.write(f"file '{video.absolute()}'\n")
+def start_merge_ffmpeg(output_path):
+    """Start an ffmpeg concat merger that reads its segment list from stdin.
 
+    Call add_merge_segment as each segment finishes and finish_merge_ffmpeg
+    once all are added; no list file is written to disk.
+    """
     cmd = [
-        'ffmpeg', '-f', 'concat',
+        'ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error', '-f', 'concat',
         '-safe', '0',
-        '-i', str(list_file),
+        '-protocol_whitelist', 'file,pipe',
+        '-fflags', '+genpts',
+        '-i', 'pipe:0',
         '-c', 'copy',
+        '-avoid_negative_ts', 'make_zero',
         '-y',
         str(output_path)
     ]
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
 
-    print(f"\nMerging {len(video_list)} segments...")
-    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+def add_merge_segment(proc, video):
+    proc.stdin.write(f"file '{Path(video).absolute()}'\n".encode())
+    proc.stdin.flush()
 
-    list_file.unlink()
+
+def finish_merge_ffmpeg(proc, output_path, segment_count):
+    print(f"\nMerging {segment_count} segments...")
+    proc.stdin.close()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
     print(f"Merged video saved to: {output_path}")
 
 
@@ -493,12 +515,19 @@ if __name__ == '__main__':
         segments_input_dir = temp_segments_dir / "input"
         segments_output_dir = temp_segments_dir / "output"
 
+        merge_proc = None
         try:
             # Split video
             segments = split_video_by_duration(args.video, args.segment_duration, segments_input_dir)
 
+            # Start the merger now and feed it each segment as it finishes
+            video_name = Path(args.video).stem
+            final_output_dir = Path(args.output) / video_name
+            final_output_dir.mkdir(parents=True, exist_ok=True)
+            final_output = final_output_dir / "inpaint_out.mp4"
+            merge_proc = start_merge_ffmpeg(final_output)
+
             # Process each segment
-            processed_videos = []
             for i, segment in enumerate(segments, 1):
                 print(f"\n{'='*60}")
                 print(f"Processing segment {i}/{len(segments)}: {segment.name}")
@@ -551,26 +580,21 @@ if __name__ == '__main__':
                     cmd.append('--cpu_cache_frames')
 
                 # Run processing
-                subprocess.run(cmd, check=True)
+                subprocess.run(cmd, check=True, stdin=subprocess.DEVNULL)
 
                 # Find the output video
                 segment_name = segment.stem
                 output_video = segments_output_dir / segment_name / "inpaint_out.mp4"
                 if not output_video.exists():
                     raise FileNotFoundError(f"Expected output not found: {output_video}")
-                processed_videos.append(output_video)
+                add_merge_segment(merge_proc, output_video)
 
             # Merge all segments
             print(f"\n{'='*60}")
             print("Merging all segments...")
             print(f"{'='*60}\n")
 
-            video_name = Path(args.video).stem
-            final_output_dir = Path(args.output) / video_name
-            final_output_dir.mkdir(parents=True, exist_ok=True)
-            final_output = final_output_dir / "inpaint_out.mp4"
-
-            merge_videos_ffmpeg(processed_videos, final_output)
+            finish_merge_ffmpeg(merge_proc, final_output, len(segments))
 
             print(f"\n{'='*60}")
             print("✓ Processing complete!")
@@ -584,6 +608,9 @@ if __name__ == '__main__':
 
         except Exception as e:
             print(f"\nError during segment processing: {e}")
+            if merge_proc is not None and merge_proc.poll() is None:
+                merge_proc.kill()
+                merge_proc.wait()
             shutil.rmtree(temp_segments_dir, ignore_errors=True)
             sys.exit(1)
 
@@ -609,10 +636,13 @@ if __name__ == '__main__':
         print()
 
     auto_mask_temp_dir = None
+    mask_input = args.mask
     if args.regions or args.region_json:
-        temp_dir, mask_path = maybe_generate_mask_from_regions(args, video_name, size[0], size[1])
+        temp_dir, mask_path, mask_array = maybe_generate_mask_from_regions(args, video_name, size[0], size[1])
         auto_mask_temp_dir = temp_dir
-        args.mask = mask_path
+        mask_input = mask_array
+        if mask_path is not None:
+            args.mask = mask_path
     if not args.width == -1 and not args.height == -1:
         size = (args.width, args.height)
     if not args.resize_ratio == 1.0:
@@ -627,7 +657,7 @@ if __name__ == '__main__':
 
     if args.mode == 'video_inpainting':
         frames_len = len(frames)
-        flow_masks, masks_dilated = read_mask(args.mask, frames_len, size,
+        flow_masks, masks_dilated = read_mask(mask_input, frames_len, size,
                                               flow_mask_dilates=args.mask_dilation,
                                               mask_dilates=args.mask_dilation)
         w, h = size
@@ -952,5 +982,5 @@ if __name__ == '__main__':
 
     torch.cuda.empty_cache()
 
-    if auto_mask_temp_dir and not args.keep_auto_mask:
-        shutil.rmtree(auto_mask_temp_dir, ignore_errors=True)
+    if auto_mask_temp_dir:
+        print(f'Auto-generated mask kept at {args.mask}')
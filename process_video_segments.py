@@ -4,53 +4,202 @@
 自动分段处理长视频：按时间切分 -> 擦除 -> 合并
 """
 import os
+import math
+import hashlib
 import sys
 import subprocess
 import argparse
 import shutil
+import queue
+import threading
+import time
 from pathlib import Path
 import tempfile
 
 
-def get_video_duration(video_path):
-    """获取视频时长（秒）"""
+# 线程间传递“没有更多片段”的标记
+_DONE = object()
+
+# ffmpeg 只输出错误信息，不向终端刷新进度
+FFMPEG_FLAGS = ['-hide_banner', '-nostats', '-loglevel', 'error']
+
+
+def default_scratch_dir(video_path):
+    """优先使用 /dev/shm（tmpfs），空间不足或不可写时退回系统临时目录
+
+    切分 ffmpeg 不受 --prefetch 限制，整段输入和所有结果可能同时留在临时目录，
+    因此要求 /dev/shm 剩余空间至少为输入文件的两倍（Docker 默认只有 64MB）。
+    """
+    shm = '/dev/shm'
+    if os.path.isdir(shm) and os.access(shm, os.W_OK):
+        stat = os.statvfs(shm)
+        if stat.f_bavail * stat.f_frsize >= 2 * os.path.getsize(video_path):
+            return shm
+    return tempfile.gettempdir()
+
+
+def read_ffconcat(list_file):
+    """读取 ffconcat 列表，返回其中的文件路径（相对路径按列表所在目录解析）
+
+    只解析以换行结尾的完整行，ffmpeg 仍在写入时也可以安全读取。
+    """
+    list_file = Path(list_file)
+    text = list_file.read_text()
+    text = text[:text.rfind('\n') + 1]
+    entries = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line.startswith('file '):
+            continue
+        name = line[len('file '):].strip().strip("'")
+        entries.append(list_file.parent / name)
+    return entries
+
+
+def probe_keyframes(video_path):
+    """读取视频流所有关键帧的时间戳（秒）及最后一个包的时间，只解析包头，不解码"""
     cmd = [
         'ffprobe', '-v', 'error',
-        '-show_entries', 'format=duration',
-        '-of', 'default=noprint_wrappers=1:nokey=1',
+        '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=p=0',
         video_path
     ]
-    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-    return float(result.stdout.strip())
-
-
-def split_video(video_path, segment_duration, output_dir):
-    """切分视频"""
+    output = subprocess.run(
+        cmd, capture_output=True, text=True, check=True, stdin=subprocess.DEVNULL
+    ).stdout
+    keyframes = []
+    end = 0.0
+    for line in output.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if pts_time in ('', 'N/A'):
+            continue
+        end = max(end, float(pts_time))
+        if flags.startswith('K'):
+            keyframes.append(float(pts_time))
+    return sorted(keyframes), end
+
+
+def balanced_segment_duration(duration, max_duration, jobs=1):
+    """在不超过 max_duration 的前提下均分视频，片段数取 jobs 的整数倍
+
+    推理耗时随片段长度超线性增长，固定时长切分留下的短尾段和多卡并行时的
+    空闲轮次都会拖慢整体；等长片段的预计耗时相同，各卡同时结束。
+    """
+    if duration <= 0:
+        return max_duration
+    count = max(1, math.ceil(duration / max_duration))
+    count = math.ceil(count / jobs) * jobs
+    return duration / count
+
+
+def pick_segment_times(keyframes, segment_duration):
+    """每隔 segment_duration 秒选离目标时间最近的关键帧作为切点，关键帧稀疏时片段时长也尽量均匀
+
+    ffmpeg 输出时会把起始时间平移到 0，因此切点以第一个关键帧为零点。
+    """
+    times = []
+    if not keyframes:
+        return times
+    start = last = keyframes[0]
+    for prev, t in zip(keyframes, keyframes[1:]):
+        target = last + segment_duration
+        if t < target:
+            continue
+        # 前一个关键帧更接近目标且不会切出过短的片段时，提前在它上面切
+        cut = prev if prev - last >= segment_duration / 2 and target - prev < t - target else t
+        times.append(cut - start)
+        last = cut
+    return times
+
+
+def start_split(video_path, segment_duration, output_dir, jobs=1):
+    """后台启动 ffmpeg 切分，返回进程和 ffconcat 列表文件"""
     output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
     output_pattern = str(output_dir / "segment_%03d.mp4")
+    list_file = output_dir / "segments.ffconcat"
+
+    # 流复制只能在关键帧处切分，直接给出对齐到关键帧的切点
+    keyframes, end = probe_keyframes(video_path)
+    if keyframes:
+        duration = end - keyframes[0]
+        print(f"Video duration: {duration:.2f}s")
+        segment_duration = balanced_segment_duration(duration, segment_duration, jobs)
+    segment_times = pick_segment_times(keyframes, segment_duration)
+    if segment_times:
+        # pts_time 只保留 6 位小数，向上取整时切点会落在目标关键帧之后而跳过它；
+        # 允许提前 1ms（远小于半帧）匹配关键帧
+        split_args = [
+            '-segment_times', ','.join(f'{t:.6f}' for t in segment_times),
+            '-segment_time_delta', '0.001',
+        ]
+        print(f"Estimated segments: {len(segment_times) + 1}")
+    else:
+        split_args = ['-segment_time', str(segment_duration)]
 
     cmd = [
-        'ffmpeg', '-i', video_path,
+        'ffmpeg', *FFMPEG_FLAGS, '-i', video_path,
         '-c', 'copy',
         '-map', '0',
-        '-segment_time', str(segment_duration),
+        *split_args,
         '-f', 'segment',
         '-reset_timestamps', '1',
+        '-segment_list', str(list_file),
+        '-segment_list_type', 'ffconcat',
         output_pattern
     ]
 
-    print(f"Splitting video into {segment_duration}s segments...")
-    subprocess.run(cmd, check=True)
+    print(f"Splitting video into {segment_duration:g}s segments...")
+    return subprocess.Popen(cmd, stdin=subprocess.DEVNULL), list_file
+
+
+def _hash_file(digest, path, chunk_size=1 << 20):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+
+def hash_mask(mask_path):
+    """蒙版（单张图片或逐帧目录）的内容哈希，每次运行只计算一次"""
+    digest = hashlib.blake2b(digest_size=16)
+    mask_path = Path(mask_path)
+    paths = sorted(mask_path.iterdir()) if mask_path.is_dir() else [mask_path]
+    for path in paths:
+        digest.update(path.name.encode() + b'\0')
+        _hash_file(digest, path)
+    return digest.hexdigest()
 
-    segments = sorted(output_dir.glob("segment_*.mp4"))
-    print(f"Created {len(segments)} segments")
-    return segments
 
+def segment_cache_key(segment_path, mask_digest, inference_args):
+    """缓存键：片段内容 + 蒙版哈希 + 推理参数
 
-def process_segment(segment_path, mask_path, output_dir, inference_args):
-    """处理单个视频段"""
+    片段切点取决于 --segment_duration 和 --jobs，改变它们后片段内容不同，缓存不会命中。
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    _hash_file(digest, segment_path)
+    digest.update(mask_digest.encode() + b'\0')
+    digest.update((inference_args or '').encode())
+    return digest.hexdigest()
+
+
+def store_cached_result(cache_dir, key, result_video):
+    """复制结果到缓存；先写临时文件再改名，并发写同一个键也不会读到半个文件"""
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        shutil.copyfile(result_video, tmp_path)
+        os.replace(tmp_path, cache_dir / f"{key}.mp4")
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+
+def process_segment(segment_path, mask_path, output_dir, inference_args, gpu_id=None):
+    """处理单个视频段（gpu_id 不为空时通过 CUDA_VISIBLE_DEVICES 绑定显卡）"""
     segment_name = segment_path.stem
     output_path = Path(output_dir) / segment_name
 
@@ -65,8 +214,13 @@ def process_segment(segment_path, mask_path, output_dir, inference_args):
     if inference_args:
         cmd.extend(inference_args.split())
 
-    print(f"\nProcessing {segment_name}...")
-    subprocess.run(cmd, check=True)
+    env = os.environ.copy()
+    if gpu_id is not None:
+        env["CUDA_VISIBLE_DEVICES"] = str(gpu_id)
+
+    device = f" on GPU {gpu_id}" if gpu_id is not None else ""
+    print(f"\nProcessing {segment_name}{device}...")
+    subprocess.run(cmd, check=True, env=env, stdin=subprocess.DEVNULL)
 
     # 返回处理后的视频路径
     result_video = output_path / "inpaint_out.mp4"
@@ -76,29 +230,220 @@ def process_segment(segment_path, mask_path, output_dir, inference_args):
     return result_video
 
 
-def merge_videos(video_list, output_path):
-    """合并视频"""
-    # 创建文件列表
-    list_file = Path(tempfile.gettempdir()) / "video_list.txt"
-    with open(list_file, 'w') as f:
-        for video in video_list:
-            f.write(f"file '{video.absolute()}'\n")
+def split_stage(proc, list_file, read_q, jobs, stop, errors, poll_interval=0.5):
+    """切分线程：ffmpeg 每写完一个片段就会在 ffconcat 列表中追加一行，据此把片段送入 read_q"""
+    seen = 0
+    try:
+        while not stop.is_set():
+            finished = proc.poll() is not None
+            entries = read_ffconcat(list_file) if list_file.exists() else []
+            for index, segment in enumerate(entries[seen:], seen + 1):
+                read_q.put((index, segment))
+            seen = len(entries)
+            if finished:
+                break
+            time.sleep(poll_interval)
+
+        if stop.is_set():
+            proc.terminate()
+            proc.wait()
+        elif proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+        else:
+            print(f"Created {seen} segments")
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        for _ in range(jobs):
+            read_q.put(_DONE)
+
+
+def inference_stage(read_q, write_q, mask_path, output_dir, inference_args, gpu_pool, stop, errors,
+                    cache_dir=None, mask_digest=None):
+    """推理线程：从 read_q 取片段处理，结果放入 write_q
+
+    指定 cache_dir 时，内容、蒙版和参数都相同的片段直接复用缓存结果，不占用显卡。
+    出错后继续取空 read_q 直到 _DONE，避免切分线程阻塞在 put 上。
+    """
+    try:
+        while True:
+            item = read_q.get()
+            if item is _DONE:
+                break
+            if stop.is_set():
+                continue
+            try:
+                write_q.put(run_inference_item(
+                    item, mask_path, output_dir, inference_args, gpu_pool,
+                    cache_dir, mask_digest
+                ))
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+    finally:
+        write_q.put(_DONE)
+
+
+def run_inference_item(item, mask_path, output_dir, inference_args, gpu_pool,
+                       cache_dir, mask_digest):
+    """处理 read_q 中的一项，返回放入 write_q 的 (序号, 结果路径)"""
+    index, segment = item
+    key = None
+    if cache_dir is not None:
+        key = segment_cache_key(segment, mask_digest, inference_args)
+        cached = Path(cache_dir) / f"{key}.mp4"
+        if cached.exists():
+            print(f"\nSegment {index}: {segment.name} unchanged, using cached result")
+            return index, cached
+    gpu_id = gpu_pool.get() if gpu_pool is not None else None
+    try:
+        print(f"\n{'='*60}")
+        print(f"Processing segment {index}: {segment.name}")
+        print(f"{'='*60}")
+        result_video = process_segment(
+            segment, mask_path, output_dir, inference_args, gpu_id
+        )
+    finally:
+        if gpu_pool is not None:
+            gpu_pool.put(gpu_id)
+    if key is not None:
+        store_cached_result(cache_dir, key, result_video)
+    return index, result_video
 
+
+def merge_stage(write_q, output_path, jobs, stop, errors):
+    """合并阶段：结果按顺序连续就绪后立即写入 ffmpeg concat 的输入管道
+
+    concat demuxer 读完整个列表后才开始封装，因此边处理边写入省去的是
+    临时列表文件和进程启动时间。
+    """
     cmd = [
-        'ffmpeg', '-f', 'concat',
+        'ffmpeg', *FFMPEG_FLAGS, '-f', 'concat',
         '-safe', '0',
-        '-i', str(list_file),
+        '-protocol_whitelist', 'file,pipe',
+        '-fflags', '+genpts',
+        '-i', 'pipe:0',
         '-c', 'copy',
+        '-avoid_negative_ts', 'make_zero',
+        '-y',
         str(output_path)
     ]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
 
-    print(f"\nMerging {len(video_list)} segments...")
-    subprocess.run(cmd, check=True)
-
-    list_file.unlink()
+    try:
+        pending = {}
+        next_index = 1
+        finished_jobs = 0
+        while finished_jobs < jobs:
+            item = write_q.get()
+            if item is _DONE:
+                finished_jobs += 1
+                continue
+            index, video = item
+            pending[index] = video
+            while next_index in pending and not stop.is_set():
+                video = pending.pop(next_index)
+                try:
+                    proc.stdin.write(f"file '{video.absolute()}'\n".encode())
+                    proc.stdin.flush()
+                except OSError as e:
+                    # 合并进程已退出，停止其它阶段但继续清空队列
+                    errors.append(e)
+                    stop.set()
+                    break
+                next_index += 1
+
+        if errors or pending or next_index == 1:
+            if errors:
+                raise errors[0]
+            raise RuntimeError("No segments were produced" if next_index == 1
+                               else f"Segment {next_index} is missing")
+
+        print(f"\nMerging {next_index - 1} segments...")
+        proc.stdin.close()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    except BaseException:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        raise
     print(f"Merged video saved to: {output_path}")
 
 
+def drain(q):
+    """清空队列，避免阻塞在 put 上的线程无法退出"""
+    try:
+        while True:
+            q.get_nowait()
+    except queue.Empty:
+        pass
+
+
+def wake_workers(q, jobs):
+    """尽量放入 jobs 个 _DONE，队列已满时放弃"""
+    try:
+        for _ in range(jobs):
+            q.put_nowait(_DONE)
+    except queue.Full:
+        pass
+
+
+def run_pipeline(video_path, mask_path, segments_dir, results_dir, output_path,
+                 segment_duration, inference_args, jobs=1, gpus=None, prefetch=2,
+                 cache_dir=None):
+    """切分、推理、合并三个阶段通过有界队列并行流水执行
+
+    每个推理线程从 GPU 队列中取一张空闲显卡，处理完后归还；
+    未指定 gpus 时沿用默认设备。cache_dir 不为空时按片段缓存推理结果。
+    """
+    read_q = queue.Queue(maxsize=prefetch)
+    write_q = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    errors = []
+
+    gpu_pool = None
+    if gpus:
+        # jobs 多于显卡数时每张卡分发多次，让多个片段共享一张卡并发处理
+        gpu_pool = queue.Queue()
+        for _ in range(math.ceil(jobs / len(gpus))):
+            for gpu_id in gpus:
+                gpu_pool.put(gpu_id)
+
+    mask_digest = hash_mask(mask_path) if cache_dir is not None else None
+
+    proc, list_file = start_split(video_path, segment_duration, segments_dir, jobs)
+    threads = [threading.Thread(
+        target=split_stage,
+        args=(proc, list_file, read_q, jobs, stop, errors),
+        daemon=True,
+    )]
+    # 推理在子进程中执行，线程即可并发调度
+    for _ in range(jobs):
+        threads.append(threading.Thread(
+            target=inference_stage,
+            args=(read_q, write_q, mask_path, results_dir, inference_args,
+                  gpu_pool, stop, errors, cache_dir, mask_digest),
+            daemon=True,
+        ))
+    for t in threads:
+        t.start()
+
+    try:
+        merge_stage(write_q, output_path, jobs, stop, errors)
+    finally:
+        stop.set()
+        for t in threads:
+            while t.is_alive():
+                # 推理线程可能已全部退出，此时切分线程会阻塞在 read_q 上；
+                # 反之被清空的 _DONE 需要补回，让仍在等待的推理线程退出
+                drain(read_q)
+                drain(write_q)
+                wake_workers(read_q, jobs)
+                t.join(timeout=0.1)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Process long videos by splitting into segments'
@@ -117,7 +462,8 @@ def main():
     )
     parser.add_argument(
         '--segment_duration', type=int, default=30,
-        help='Segment duration in seconds (default: 30)'
+        help='Maximum segment duration in seconds; the video is split into equal-length '
+             'segments, a multiple of --jobs in number (default: 30)'
     )
     parser.add_argument(
         '--keep_segments', action='store_true',
@@ -127,9 +473,42 @@ def main():
         '--inference_args', type=str, default='--ultra_low_memory',
         help='Arguments to pass to inference_propainter.py (default: --ultra_low_memory)'
     )
+    parser.add_argument(
+        '--jobs', type=int, default=None,
+        help='Number of segments processed concurrently (default: number of GPUs, or 1). '
+             'With --gpus, jobs beyond the GPU count share GPUs round-robin'
+    )
+    parser.add_argument(
+        '--gpus', type=str, default=None,
+        help='Comma-separated CUDA device ids to spread segments across, e.g. 0,1'
+    )
+
+    parser.add_argument(
+        '--prefetch', type=int, default=2,
+        help='Segment paths queued between split, inference and merge stages (default: 2). '
+             'Does not bound the segment files on disk: splitting runs ahead independently'
+    )
+    parser.add_argument(
+        '--scratch_dir', type=str, default=None,
+        help='Directory for temporary segments and results (default: /dev/shm if it has at '
+             'least twice the input size free, otherwise the system temp dir)'
+    )
+    parser.add_argument(
+        '--cache_dir', type=str, default=None,
+        help='Enable caching of per-segment results in this directory, keyed by segment '
+             'content, mask and inference args. Segment boundaries depend on '
+             '--segment_duration and --jobs, so changing either misses the cache. '
+             'The cache is never pruned (default: disabled)'
+    )
 
     args = parser.parse_args()
 
+    gpus = [g.strip() for g in args.gpus.split(',') if g.strip()] if args.gpus else []
+    jobs = args.jobs if args.jobs is not None else max(1, len(gpus))
+    if jobs < 1:
+        print(f"Error: --jobs must be at least 1, got {jobs}")
+        return 1
+
     # 验证输入
     if not os.path.exists(args.video):
         print(f"Error: Video not found: {args.video}")
@@ -139,41 +518,25 @@ def main():
         print(f"Error: Mask not found: {args.mask}")
         return 1
 
-    # 创建临时目录
-    temp_dir = Path(tempfile.mkdtemp(prefix="propainter_segments_"))
+    # 创建临时目录（默认放在内存文件系统 /dev/shm，避免片段落盘后再读回）
+    scratch = args.scratch_dir or default_scratch_dir(args.video)
+    temp_dir = Path(tempfile.mkdtemp(prefix="propainter_segments_", dir=scratch))
     segments_dir = temp_dir / "segments"
     results_dir = temp_dir / "results"
 
     try:
-        # 1. 获取视频时长
-        duration = get_video_duration(args.video)
-        print(f"Video duration: {duration:.2f}s")
-        estimated_segments = int(duration / args.segment_duration) + 1
-        print(f"Estimated segments: {estimated_segments}")
-
-        # 2. 切分视频
-        segments = split_video(args.video, args.segment_duration, segments_dir)
-
-        # 3. 处理每个片段
-        processed_videos = []
-        for i, segment in enumerate(segments, 1):
-            print(f"\n{'='*60}")
-            print(f"Processing segment {i}/{len(segments)}: {segment.name}")
-            print(f"{'='*60}")
-
-            result_video = process_segment(
-                segment, args.mask, results_dir, args.inference_args
-            )
-            processed_videos.append(result_video)
-
-        # 4. 合并视频
-        print(f"\n{'='*60}")
-        print("Merging all segments...")
-        print(f"{'='*60}")
+        # 切分 -> 处理 -> 合并 流水执行
+        if jobs > 1:
+            print(f"Processing segments with {jobs} parallel jobs")
 
         output_path = Path(args.output)
         output_path.parent.mkdir(parents=True, exist_ok=True)
-        merge_videos(processed_videos, output_path)
+        run_pipeline(
+            args.video, args.mask, segments_dir, results_dir, output_path,
+            args.segment_duration, args.inference_args,
+            jobs=jobs, gpus=gpus, prefetch=args.prefetch,
+            cache_dir=Path(args.cache_dir) if args.cache_dir else None
+        )
 
         print(f"\n{'='*60}")
         print("✓ Processing complete!")
@@ -182,7 +545,7 @@ def main():
 
         return 0
 
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, RuntimeError, FileNotFoundError) as e:
         print(f"\nError during processing: {e}")
         return 1
 
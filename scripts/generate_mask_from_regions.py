@@ -5,7 +5,8 @@ Generate binary mask images from normalized regions for video inpainting.
 Given a video (or a folder of frames) and a list of regions defined in a
 left-bottom-origin coordinate system, this script creates a black background
 mask where the specified regions are painted white. The output can be a single
-mask image (reused for every frame) or a folder of per-frame masks.
+mask image (reused for every frame) or, when the regions change over time,
+a folder of per-frame masks.
 """
 
 from __future__ import annotations
@@ -13,6 +14,11 @@ from __future__ import annotations
 import argparse
 import json
 import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from functools import lru_cache
 from pathlib import Path
 from typing import Iterable, List, Sequence, Tuple
 
@@ -66,33 +72,115 @@ def parse_json_regions(json_path: str | None) -> List[Tuple[float, float, float,
     return regions
 
 
-def get_video_metadata(video_path: Path) -> Tuple[int, int, int]:
+def parse_json_frame_regions(json_path: str) -> List[List[Tuple[float, float, float, float]]]:
     """
-    Returns width, height, and frame count.
+    Parse a JSON list with one entry per frame, each entry being a list of
+    [left, top, right, bottom] regions for that frame.
+    """
+    with open(json_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, list):
+        raise ValueError("JSON per-frame regions must be a list with one list of regions per frame.")
+    frames = []
+    for frame_idx, frame_regions in enumerate(data):
+        if not isinstance(frame_regions, list):
+            raise ValueError(f"Frame entry #{frame_idx} is not a list of regions: {frame_regions}")
+        regions = []
+        for idx, region in enumerate(frame_regions):
+            if not isinstance(region, Sequence) or len(region) != 4:
+                raise ValueError(f"Region entry #{idx} of frame #{frame_idx} is invalid: {region}")
+            regions.append(tuple(float(v) for v in region))  # type: ignore[arg-type]
+        frames.append(regions)
+    return frames
+
+
+def _probe(video_path: Path) -> dict:
+    """
+    Read the first video stream's header fields with ffprobe, without decoding.
+    """
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "stream=width,height,nb_frames,avg_frame_rate,duration:format=duration",
+        "-of", "json",
+        str(video_path),
+    ]
+    try:
+        info = json.loads(subprocess.check_output(cmd, stdin=subprocess.DEVNULL))
+    except (OSError, subprocess.CalledProcessError) as exc:
+        raise ValueError(f"Unable to probe video {video_path}: {exc}") from exc
+    streams = info.get("streams") or []
+    if not streams:
+        raise ValueError(f"No video stream found in {video_path}")
+    stream = streams[0]
+    stream.setdefault("format_duration", info.get("format", {}).get("duration"))
+    return stream
+
+
+def _probe_frame_count(stream: dict) -> Tuple[int, bool]:
+    """
+    Frame count from the container header, estimated from duration and frame
+    rate when the container does not record it. Also returns whether the
+    count is exact (read from nb_frames) rather than estimated.
+    """
+    nb_frames = stream.get("nb_frames")
+    if nb_frames not in (None, "N/A"):
+        return int(nb_frames), True
+    duration = stream.get("duration")
+    if duration in (None, "N/A"):
+        duration = stream.get("format_duration")
+    rate = stream.get("avg_frame_rate", "0/0")
+    if duration in (None, "N/A") or rate.endswith("/0"):
+        return 0, False
+    return int(round(float(duration) * Fraction(rate))), False
+
+
+def get_video_metadata(video_path: Path, count_frames: bool = True) -> Tuple[int, int, int]:
+    """
+    Returns width, height, and frame count. The frame count is 0 when
+    count_frames is False, which lets a folder of frames be probed from a
+    single sample instead of listing every file.
+    """
+    width, height, frame_count, _ = _video_metadata(video_path, count_frames)
+    return width, height, frame_count
+
+
+def _video_metadata(video_path: Path, count_frames: bool) -> Tuple[int, int, int, bool]:
+    """
+    get_video_metadata plus whether the frame count is exact: true for frame
+    folders and containers recording nb_frames, false when it is estimated.
     """
     if video_path.is_dir():
-        frame_paths = sorted(
-            [p for p in video_path.iterdir() if p.suffix.lower() in EXTENSIONS]
-        )
-        if not frame_paths:
+        # scandir returns names and d_type from the directory listing, so large
+        # frame folders are scanned without a stat() per file.
+        with os.scandir(video_path) as entries:
+            frame_paths = (
+                entry.path
+                for entry in entries
+                if entry.is_file() and os.path.splitext(entry.name)[1].lower() in EXTENSIONS
+            )
+            if count_frames:
+                frame_paths = list(frame_paths)
+                frame_count = len(frame_paths)
+                sample_path = min(frame_paths, default=None)
+            else:
+                frame_count = 0
+                sample_path = next(frame_paths, None)
+        if sample_path is None:
             raise FileNotFoundError(f"No image frames found in {video_path}.")
-        sample = cv2.imread(str(frame_paths[0]))
+        sample = cv2.imread(sample_path)
         if sample is None:
-            raise ValueError(f"Failed to read sample frame: {frame_paths[0]}")
+            raise ValueError(f"Failed to read sample frame: {sample_path}")
         height, width = sample.shape[:2]
-        frame_count = len(frame_paths)
-        return width, height, frame_count
-
-    cap = cv2.VideoCapture(str(video_path))
-    if not cap.isOpened():
-        raise ValueError(f"Unable to open video {video_path}")
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    cap.release()
+        return width, height, frame_count, count_frames
+
+    stream = _probe(video_path)
+    width = int(stream.get("width", 0))
+    height = int(stream.get("height", 0))
+    frame_count, exact = _probe_frame_count(stream) if count_frames else (0, False)
     if width <= 0 or height <= 0:
         raise ValueError(f"Invalid video resolution ({width}x{height}) for {video_path}")
-    return width, height, max(frame_count, 1)
+    return width, height, max(frame_count, 1) if count_frames else 0, exact
 
 
 def convert_region_to_pixels(
@@ -130,6 +218,40 @@ def convert_region_to_pixels(
     return x1, y1, x2, y2
 
 
+def merge_pixel_rects(
+    rects: Iterable[Tuple[int, int, int, int]],
+) -> List[Tuple[int, int, int, int]]:
+    """
+    Union end-exclusive (x1, y1, x2, y2) pixel rects into non-overlapping
+    rects by sweeping horizontal bands and merging x-intervals in each band.
+    render_mask depends on this: cv2.fillPoly uses the even-odd rule, so
+    overlapping polygons drawn in one call leave their intersection unfilled.
+    """
+    rects = list(set(rects))
+    if not rects:
+        return []
+    ys = sorted({y for r in rects for y in (r[1], r[3])})
+    merged: List[Tuple[int, int, int, int]] = []
+    open_strips = {}  # (x1, x2) -> y1 of a strip still growing downwards
+    for y_top, y_bottom in zip(ys, ys[1:]):
+        spans = sorted((r[0], r[2]) for r in rects if r[1] <= y_top and r[3] >= y_bottom)
+        intervals: List[Tuple[int, int]] = []
+        for x1, x2 in spans:
+            if intervals and x1 <= intervals[-1][1]:
+                intervals[-1] = (intervals[-1][0], max(intervals[-1][1], x2))
+            else:
+                intervals.append((x1, x2))
+        next_strips = {}
+        for interval in intervals:
+            next_strips[interval] = open_strips.pop(interval, y_top)
+        for (x1, x2), y1 in open_strips.items():
+            merged.append((x1, y1, x2, y_top))
+        open_strips = next_strips
+    for (x1, x2), y1 in open_strips.items():
+        merged.append((x1, y1, x2, ys[-1]))
+    return merged
+
+
 def render_mask(
     width: int,
     height: int,
@@ -137,9 +259,20 @@ def render_mask(
     origin: str,
 ) -> np.ndarray:
     mask = np.zeros((height, width), dtype=np.uint8)
-    for region in regions:
-        x1, y1, x2, y2 = convert_region_to_pixels(region, width, height, origin)
-        mask[y1:y2, x1:x2] = 255
+    if not regions:
+        return mask
+    # Rects must be disjoint before the single fillPoly call (even-odd fill).
+    rects = np.array(
+        merge_pixel_rects(convert_region_to_pixels(region, width, height, origin) for region in regions),
+        dtype=np.int32,
+    )
+    # fillPoly includes edge pixels, while pixel rects are end-exclusive.
+    x1, y1, x2, y2 = rects[:, 0], rects[:, 1], rects[:, 2] - 1, rects[:, 3] - 1
+    polys = np.stack(
+        [np.stack([x1, y1], 1), np.stack([x2, y1], 1), np.stack([x2, y2], 1), np.stack([x1, y2], 1)],
+        axis=1,
+    )
+    cv2.fillPoly(mask, list(polys), 255)
     return mask
 
 
@@ -149,12 +282,63 @@ def write_single_mask(mask: np.ndarray, output_path: Path) -> None:
         raise IOError(f"Failed to write mask to {output_path}")
 
 
-def write_per_frame_masks(mask: np.ndarray, output_dir: Path, frame_count: int) -> None:
+@lru_cache(maxsize=32)
+def encode_mask_png(
+    width: int,
+    height: int,
+    regions: Tuple[Tuple[float, float, float, float], ...],
+    origin: str,
+) -> bytes:
+    """
+    Render and PNG-encode a mask, caching the bytes so repeated region sets
+    (within a run or across in-process run() calls) skip render and libpng.
+    """
+    ok, png = cv2.imencode(".png", render_mask(width, height, list(regions), origin))
+    if not ok:
+        raise IOError(f"Failed to encode mask for regions {regions}")
+    return png.tobytes()
+
+
+def write_per_frame_masks(
+    width: int,
+    height: int,
+    frame_regions: List[List[Tuple[float, float, float, float]]],
+    origin: str,
+    output_dir: Path,
+    max_workers: int = 16,
+) -> None:
+    """
+    Encode each distinct set of regions once and hardlink it for every other
+    frame sharing it. On filesystems without hardlink support the encoded
+    bytes are written directly, with up to max_workers writes in flight so
+    high-latency (network/FUSE) storage is not hit one file at a time.
+    """
     output_dir.mkdir(parents=True, exist_ok=True)
-    for idx in range(frame_count):
-        out_path = output_dir / f"{idx:05d}.png"
-        if not cv2.imwrite(str(out_path), mask):
-            raise IOError(f"Failed to write mask for frame {idx} to {out_path}")
+    first_paths = {}
+    use_links = True
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = []
+        for idx, regions in enumerate(frame_regions):
+            out_path = output_dir / f"{idx:05d}.png"
+            key = tuple(regions)
+            # A previous run may have left this file hardlinked to another
+            # frame; writing through it would overwrite that frame too.
+            out_path.unlink(missing_ok=True)
+            if key not in first_paths:
+                data = encode_mask_png(width, height, key, origin)
+                out_path.write_bytes(data)
+                first_paths[key] = (out_path, data)
+                continue
+            src_path, data = first_paths[key]
+            if use_links:
+                try:
+                    os.link(src_path, out_path)
+                    continue
+                except OSError:
+                    use_links = False
+            pending.append(pool.submit(out_path.write_bytes, data))
+        for future in pending:
+            future.result()
 
 
 def infer_default_output(video_path: Path, per_frame: bool) -> Path:
@@ -163,7 +347,7 @@ def infer_default_output(video_path: Path, per_frame: bool) -> Path:
     return Path("results") / f"{video_name}_{suffix}"
 
 
-def main() -> None:
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Generate mask images from normalized regions.")
     parser.add_argument(
         "--video",
@@ -186,6 +370,13 @@ def main() -> None:
         default=None,
         help="Optional path to a JSON file containing a list of regions.",
     )
+    parser.add_argument(
+        "--regions-per-frame",
+        type=str,
+        default=None,
+        help="JSON file with one list of regions per frame, for regions that change over time. "
+        "Regions from --region/--region-json are added to every frame. Implies --per-frame.",
+    )
     parser.add_argument(
         "--output",
         type=str,
@@ -195,7 +386,8 @@ def main() -> None:
     parser.add_argument(
         "--per-frame",
         action="store_true",
-        help="Save one mask per frame instead of a single shared mask.",
+        help="Save one mask per frame instead of a single shared mask. Only takes effect with "
+        "--regions-per-frame; static regions always produce a single shared mask.",
     )
     parser.add_argument(
         "--origin",
@@ -203,8 +395,15 @@ def main() -> None:
         default="left-bottom",
         help="Coordinate origin used by the normalized regions. Default: left-bottom.",
     )
-    args = parser.parse_args()
+    return parser
+
 
+def run(args: argparse.Namespace) -> Path:
+    """
+    Generate the mask(s) described by parsed arguments and return the output
+    path. Lets other scripts call this in-process instead of spawning a new
+    interpreter; ``args`` must carry every option defined by build_parser().
+    """
     video_path = Path(args.video).expanduser().resolve()
     if not video_path.exists():
         raise FileNotFoundError(f"Input video or folder not found: {video_path}")
@@ -212,26 +411,57 @@ def main() -> None:
     cli_regions = args.regions if args.regions else []
     json_regions = parse_json_regions(args.region_json)
     regions = parse_regions([tuple(region) for region in cli_regions + json_regions], args.origin)
-    if not regions:
-        raise ValueError("At least one region must be provided via --region or --region-json.")
+    frame_regions = None
+    if args.regions_per_frame:
+        frame_regions = [
+            regions + parse_regions(frame, args.origin)
+            for frame in parse_json_frame_regions(args.regions_per_frame)
+        ]
+        if not any(frame_regions):
+            raise ValueError(f"No regions found in {args.regions_per_frame}.")
+    elif not regions:
+        raise ValueError(
+            "At least one region must be provided via --region, --region-json or --regions-per-frame."
+        )
+    elif args.per_frame:
+        print("Warning: regions are static; --per-frame ignored", file=sys.stderr)
 
-    width, height, frame_count = get_video_metadata(video_path)
-    mask = render_mask(width, height, regions, args.origin)
+    per_frame = frame_regions is not None
+    width, height, frame_count, exact_count = _video_metadata(video_path, count_frames=per_frame)
 
-    output_path = Path(args.output).expanduser().resolve() if args.output else infer_default_output(video_path, args.per_frame)
+    output_path = Path(args.output).expanduser().resolve() if args.output else infer_default_output(video_path, per_frame)
 
-    if args.per_frame:
+    if per_frame:
         if output_path.suffix:
-            raise ValueError("When using --per-frame, --output must be a directory path.")
-        write_per_frame_masks(mask, output_path, frame_count)
+            raise ValueError("When using --regions-per-frame, --output must be a directory path.")
+        if len(frame_regions) != frame_count:
+            if exact_count:
+                raise ValueError(
+                    f"--regions-per-frame lists {len(frame_regions)} frames but the video has {frame_count}."
+                )
+            # Estimated from duration * frame rate, which is often off by a frame.
+            print(
+                f"Warning: --regions-per-frame lists {len(frame_regions)} frames but the video is "
+                f"estimated at {frame_count}; using the JSON frame count",
+                file=sys.stderr,
+            )
+            frame_count = len(frame_regions)
+        write_per_frame_masks(width, height, frame_regions, args.origin, output_path)
         print(f"Wrote {frame_count} mask frames to {output_path}")
     else:
-        if output_path.is_dir():
+        mask = render_mask(width, height, regions, args.origin)
+        if output_path.is_dir() or not output_path.suffix:
             output_path = output_path / "mask.png"
         write_single_mask(mask, output_path)
         print(f"Wrote mask image to {output_path}")
 
-    print(f"Input resolution: {width}x{height}, regions: {len(regions)}")
+    region_count = sum(len(r) for r in frame_regions) if per_frame else len(regions)
+    print(f"Input resolution: {width}x{height}, regions: {region_count}")
+    return output_path
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    run(build_parser().parse_args(argv))
 
 
 if __name__ == "__main__":